@@ -1,23 +1,51 @@
+from __future__ import division
+from __future__ import print_function
+
 import os
 import errno
 import json
 import math
+import shutil
+import tempfile
 import boto3
 import mercantile
 import numpy
 import rasterio
 
-from urlparse import urlparse
 from collections import namedtuple
 
-from rasterio import transform
+from boto3.s3.transfer import S3Transfer, TransferConfig
 from rasterio import warp
-from rasterio.warp import calculate_default_transform
+from rasterio.warp import RESAMPLING, calculate_default_transform
 from rasterio._io import virtual_file_to_buffer
 
+try:
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    from urlparse import urlparse
+
 APP_NAME = "Raster Foundry Tiler Chunk"
 TILE_DIM = 1024
 STATUS_QUEUE_REGION = "us-east-1"
+WEB_MERCATOR_ORIGIN = math.pi * 6378137  # meters from origin to edge
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 10
+PARTITIONS_PER_CORE = 3
+TILE_VSIMEM_PATH = "/vsimem/chunk-tile.tif"
+WARP_THREADS = 1  # Spark already runs one chunk partition per core
+
+# Block shapes of GeoTIFFs that are read in place instead of being
+# copied to the workspace first
+TILED_BLOCK_SHAPES = [(256, 256), (512, 512), (1024, 1024)]
+
+# GDAL configuration used while reading sources and writing tiles
+GDAL_CONFIG = {
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff",
+    "GDAL_DISABLE_READDIR_ON_OPEN": "TRUE",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(256 * 1024 * 1024),
+    "GDAL_CACHEMAX": "512"  # MB
+}
 
 
 def notify(queue_url, m):
@@ -78,7 +106,16 @@ UriSet = namedtuple(
 ImageSource = namedtuple(
     'ImageSource',
     'origin_uri source_uri src_bounds src_shape src_crs zoom ll_bounds tile_bounds image_folder order')  # NOQA
-ChunkTask = namedtuple('ChunkTask', "source_uri target_meta target")
+ChunkTask = namedtuple('ChunkTask', "source_uri target_meta target col row")
+
+# The source image currently open on this worker, keyed by source URI
+_source_cache = {}
+
+# boto3 clients created by this worker, keyed by service name
+_client_cache = {}
+
+# Warped tile buffers reused by this worker, keyed by shape and dtype
+_buffer_cache = {}
 
 
 def vsi_curlify(uri):
@@ -96,22 +133,37 @@ def vsi_curlify(uri):
         elif parsed.scheme == "http":
             result_uri = "/vsicurl/%s" % uri
         else:
-            raise Exception("Unsupported scheme: %s" % parsed.schem)
+            raise Exception("Unsupported scheme: %s" % parsed.scheme)
 
     return result_uri
 
 
+def get_client(service_name):
+    """
+    Returns a boto3 client, reusing it (and its connection pool)
+    for every upload made by this worker
+    """
+    if service_name not in _client_cache:
+        _client_cache[service_name] = boto3.client(service_name)
+
+    return _client_cache[service_name]
+
+
 def write_bytes_to_target(target_uri, contents):
+    """
+    Writes a buffer (e.g. a view of a /vsimem/ file) to the
+    target (s3 or local), copying it at most once
+    """
     parsed_target = urlparse(target_uri)
     if parsed_target.scheme == "s3":
-        client = boto3.client("s3")
+        client = get_client("s3")
 
         bucket = parsed_target.netloc
         key = parsed_target.path[1:]
 
         client.put_object(
             ACL="public-read",
-            Body=bytes(contents),
+            Body=memoryview(contents).tobytes(),
             Bucket=bucket,
             # CacheControl="TODO",
             ContentType="image/tiff",
@@ -121,26 +173,49 @@ def write_bytes_to_target(target_uri, contents):
         output_path = target_uri
         mkdir_p(os.path.dirname(output_path))
 
-        with open(output_path, "w") as f:
+        with open(output_path, "wb") as f:
             f.write(contents)
 
 
+def write_file_to_target(target_uri, path):
+    """
+    Copies a local file to the target (s3 or local), using concurrent
+    multipart uploads for large files on s3
+    """
+    parsed_target = urlparse(target_uri)
+    if parsed_target.scheme == "s3":
+        config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                max_concurrency=MULTIPART_CONCURRENCY)
+        transfer = S3Transfer(get_client("s3"), config)
+
+        bucket = parsed_target.netloc
+        key = parsed_target.path[1:]
+
+        transfer.upload_file(path, bucket, key, extra_args={
+            "ACL": "public-read",
+            "ContentType": "image/tiff"
+        })
+    else:
+        output_path = target_uri
+        mkdir_p(os.path.dirname(output_path))
+
+        shutil.copyfile(path, output_path)
+
+
 def create_uri_sets(images, workspace_uri):
     result = []
-    workspace_keys = []
+    workspace_keys = set()
     for (order, uri) in enumerate(images):
         source_uri = vsi_curlify(uri)
 
         # Get the workspace
-        workspace_key = get_filename(uri)
-        i = 1
+        filename = get_filename(uri)
+        workspace_key = filename
+        i = 0
         while workspace_key in workspace_keys:
-            if i > 2:
-                workspace_key = workspace_key[:-2] + "-" + str(i)
-            else:
-                workspace_key = workspace_key + "-" + str(i)
-            i + 1
-        workspace_keys.append(workspace_key)
+            i += 1
+            workspace_key = filename + "-" + str(i)
+        workspace_keys.add(workspace_key)
 
         workspace_target = os.path.join(workspace_uri,
                                         "%s-workingcopy.tif" % workspace_key)
@@ -159,6 +234,28 @@ def create_uri_sets(images, workspace_uri):
     return result
 
 
+def get_predictor(dtype):
+    """
+    Returns the GeoTIFF predictor suited to the data type:
+    floating point prediction for floats, horizontal otherwise
+    """
+    if numpy.issubdtype(numpy.dtype(dtype), numpy.floating):
+        return 3
+    else:
+        return 2
+
+
+def is_tiled_geotiff(source_uri):
+    """
+    Checks whether the image is already a tiled GeoTIFF, which can
+    be read efficiently with range requests without a workspace copy
+    """
+    with rasterio.drivers(**GDAL_CONFIG):
+        with rasterio.open(source_uri, "r") as src:
+            return (src.driver == "GTiff" and
+                    src.block_shapes[0] in TILED_BLOCK_SHAPES)
+
+
 def copy_to_workspace(source_uri, dest_uri):
     """
     Translates an image from a URI to a compressed, tiled GeoTIFF
@@ -169,28 +266,38 @@ def copy_to_workspace(source_uri, dest_uri):
         "driver": "GTiff",
         "tiled": True,
         "compress": "lzw",
-        "predictor": 2,
         "sparse_ok": True,
         "blockxsize": 512,
         "blockysize": 512
     }
 
-    with rasterio.open(source_uri, "r") as src:
-        meta = src.meta.copy()
-        meta.update(creation_options)
-
-        tmp_path = "/vsimem/" + get_filename(dest_uri)
-
-        with rasterio.open(tmp_path, "w", **meta) as tmp:
-            tmp.write(src.read())
-
-    contents = bytearray(virtual_file_to_buffer(tmp_path))
+    (tmp_fd, tmp_path) = tempfile.mkstemp(suffix=".tif")
+    os.close(tmp_fd)
 
-    write_bytes_to_target(dest_uri, contents)
+    try:
+        with rasterio.drivers(**GDAL_CONFIG):
+            with rasterio.open(source_uri, "r") as src:
+                meta = src.meta.copy()
+                meta.update(creation_options)
+                meta["predictor"] = get_predictor(meta["dtype"])
+
+                # Copy one row of blocks at a time, so the full image is
+                # never held in memory.
+                block_rows = creation_options["blockysize"]
+                with rasterio.open(tmp_path, "w", **meta) as tmp:
+                    for row in range(0, src.height, block_rows):
+                        window = ((row, min(row + block_rows, src.height)),
+                                  (0, src.width))
+                        tmp.write(src.read(window=window), window=window)
+
+        write_file_to_target(dest_uri, tmp_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def get_zoom(resolution, tile_dim):
-    zoom = math.log((2 * math.pi * 6378137) / (resolution * tile_dim)) / math.log(2)  # NOQA
+    zoom = math.log(2 * WEB_MERCATOR_ORIGIN / (resolution * tile_dim), 2)
     if zoom - int(zoom) > 0.20:
         return int(zoom) + 1
     else:
@@ -198,7 +305,7 @@ def get_zoom(resolution, tile_dim):
 
 
 def create_image_source(origin_uri, source_uri, image_folder, order, tile_dim):
-    with rasterio.drivers():
+    with rasterio.drivers(**GDAL_CONFIG):
         with rasterio.open(source_uri) as src:
             (ll_transform, ll_cols, ll_rows) = \
                 calculate_default_transform(src.crs,
@@ -242,40 +349,96 @@ def create_image_source(origin_uri, source_uri, image_folder, order, tile_dim):
 
 
 def generate_chunk_tasks(image_source, tile_dim):
-    tasks = []
     zoom = image_source.zoom
     (min_col, max_col) = (image_source.tile_bounds[0],
                           image_source.tile_bounds[2])
     (min_row, max_row) = (image_source.tile_bounds[1],
                           image_source.tile_bounds[3])
 
-    for tile_col in range(min_col, min(max_col + 1, 2 ** zoom)):
-        for tile_row in range(min_row, min(max_row + 1, 2 ** zoom)):
-            tile_bounds = mercantile.bounds(tile_col, tile_row, zoom)
-            (wm_left, wm_bottom, wm_right, wm_top) = \
-                warp.transform_bounds("EPSG:4326",
-                                      "EPSG:3857",
-                                      tile_bounds.west,
-                                      tile_bounds.south,
-                                      tile_bounds.east,
-                                      tile_bounds.north)
-            affine = transform.from_bounds(wm_left, wm_bottom, wm_right,
-                                           wm_top, tile_dim, tile_dim)
-            target_meta = {
-                "transform": affine[:6],
-                "width": tile_dim,
-                "height": tile_dim
-            }
-
-            target = os.path.join(image_source.image_folder,
-                                  "%d/%d/%d.tif" % (zoom, tile_col, tile_row))
-            task = ChunkTask(source_uri=image_source.source_uri,
-                             target_meta=target_meta,
-                             target=target)
-
-            tasks.append(task)
-
-    return tasks
+    # Web Mercator tile transforms are plain arithmetic on the tile
+    # index, so no per-tile projection is needed.
+    res = 2 * WEB_MERCATOR_ORIGIN / (tile_dim * 2 ** zoom)
+    tile_size = tile_dim * res
+
+    (tile_cols, tile_rows) = numpy.meshgrid(
+        numpy.arange(min_col, min(max_col + 1, 2 ** zoom)),
+        numpy.arange(min_row, min(max_row + 1, 2 ** zoom)),
+        indexing="ij")
+    tile_cols = tile_cols.ravel()
+    tile_rows = tile_rows.ravel()
+    lefts = tile_cols * tile_size - WEB_MERCATOR_ORIGIN
+    tops = WEB_MERCATOR_ORIGIN - tile_rows * tile_size
+    prefix = "%s/%d/" % (image_source.image_folder, zoom)
+
+    return [ChunkTask(source_uri=image_source.source_uri,
+                      target_meta={
+                          "transform": (res, 0.0, left, 0.0, -res, top),
+                          "width": tile_dim,
+                          "height": tile_dim
+                      },
+                      target=prefix + str(col) + "/" + str(row) + ".tif",
+                      col=col,
+                      row=row)
+            for (col, row, left, top) in zip(tile_cols.tolist(),
+                                             tile_rows.tolist(),
+                                             lefts.tolist(),
+                                             tops.tolist())]
+
+
+def open_source(source_uri):
+    """
+    Opens the source image, reusing the dataset for every tile
+    of that image processed by this worker. Any other source left
+    open is closed first, since tasks arrive grouped by source.
+    """
+    if source_uri not in _source_cache:
+        close_sources()
+        _source_cache[source_uri] = rasterio.open(source_uri, "r")
+
+    return _source_cache[source_uri]
+
+
+def close_sources():
+    """
+    Closes the source images opened by open_source
+    """
+    for src in _source_cache.values():
+        src.close()
+    _source_cache.clear()
+
+
+def get_source_window(src, dst_crs, dst_bounds, padding=2):
+    """
+    Returns the window of the source image that covers the given
+    bounds, padded to leave room for the resampling kernel and
+    expanded to whole source blocks, so that reads for neighboring
+    tiles are served from the GDAL block cache
+    """
+    (left, bottom, right, top) = warp.transform_bounds(dst_crs, src.crs,
+                                                       *dst_bounds)
+    ((row_start, row_stop), (col_start, col_stop)) = \
+        src.window(left, bottom, right, top, boundless=True)
+
+    (block_rows, block_cols) = src.block_shapes[0]
+    row_start = (row_start - padding) // block_rows * block_rows
+    col_start = (col_start - padding) // block_cols * block_cols
+    row_stop = -(-(row_stop + padding) // block_rows) * block_rows
+    col_stop = -(-(col_stop + padding) // block_cols) * block_cols
+
+    return ((max(row_start, 0), min(row_stop, src.height)),
+            (max(col_start, 0), min(col_stop, src.width)))
+
+
+def get_tile_buffer(count, rows, cols, dtype):
+    """
+    Returns a (count, rows, cols) array to warp tiles into, reused
+    for every tile of the same shape and dtype on this worker
+    """
+    key = (count, rows, cols, dtype)
+    if key not in _buffer_cache:
+        _buffer_cache[key] = numpy.empty((count, rows, cols), dtype=dtype)
+
+    return _buffer_cache[key]
 
 
 def process_chunk_task(task):
@@ -286,56 +449,86 @@ def process_chunk_task(task):
     Returns the extent of the output raster.
     """
 
-    from rasterio.warp import RESAMPLING
-
     creation_options = {
         "driver": "GTiff",
         "crs": "EPSG:3857",
         "tiled": True,
         "compress": "deflate",
-        "predictor": 2,  # 3 for floats, 2 otherwise
         "sparse_ok": True
     }
 
-    with rasterio.open(task.source_uri, "r") as src:
-        meta = src.meta.copy()
-        meta.update(creation_options)
-        meta.update(task.target_meta)
+    src = open_source(task.source_uri)
 
-        cols = meta["width"]
-        rows = meta["height"]
+    meta = src.meta.copy()
+    meta.update(creation_options)
+    meta.update(task.target_meta)
+    meta["predictor"] = get_predictor(meta["dtype"])
 
-        tmp_path = "/vsimem/" + get_filename(task.target)
+    cols = meta["width"]
+    rows = meta["height"]
 
-        with rasterio.open(tmp_path, "w", **meta) as tmp:
-            # Reproject the src dataset into image tile.
-            warped = []
-            for bidx in src.indexes:
-                source = rasterio.band(src, bidx)
-                warped.append(numpy.zeros((cols, rows), dtype=meta['dtype']))
+    (a, _, c, _, e, f) = meta["transform"]
+    dst_bounds = (c, f + e * rows, c + a * cols, f)
+    window = get_source_window(src, meta["crs"], dst_bounds)
+    ((row_start, row_stop), (col_start, col_stop)) = window
+    if row_start >= row_stop or col_start >= col_stop:
+        return
 
-                warp.reproject(
-                    source=source,
-                    src_nodata=0,
-                    destination=warped[bidx - 1],
-                    dst_transform=meta["transform"],
-                    dst_crs=meta["crs"],
-                    resampling=RESAMPLING.bilinear,
-                )
+    # skip the warp entirely when the source window is all zeros
+    data = src.read(window=window)
+    if not data.any():
+        return
 
-            # check for chunks containing only zero values
-            if not any(map(lambda b: b.any(), warped)):
-                return
+    # Reproject only the overlapping window of the src dataset,
+    # all bands at once, into the image tile. Every pixel of the
+    # buffer is overwritten, with 0 wherever the source has no data.
+    warped = get_tile_buffer(src.count, rows, cols, meta['dtype'])
+    warp.reproject(
+        source=data,
+        src_transform=src.window_transform(window),
+        src_crs=src.crs,
+        src_nodata=0,
+        destination=warped,
+        dst_transform=meta["transform"],
+        dst_crs=meta["crs"],
+        resampling=RESAMPLING.bilinear,
+        num_threads=WARP_THREADS,
+    )
 
-            # write out our warped data to the vsimem raster
-            for bidx in src.indexes:
-                tmp.write_band(bidx, warped[bidx - 1])
+    # check for chunks containing only zero values
+    if not warped.any():
+        return
 
-    contents = bytearray(virtual_file_to_buffer(tmp_path))
+    # write out our warped data to the vsimem raster. Tiles are
+    # written one at a time to this single path, which is truncated
+    # and reused, so at most one tile buffer is held in memory.
+    with rasterio.open(TILE_VSIMEM_PATH, "w", **meta) as tmp:
+        tmp.write(warped)
+
+    contents = virtual_file_to_buffer(TILE_VSIMEM_PATH)
 
     write_bytes_to_target(task.target, contents)
 
 
+def process_chunk_tasks(tasks):
+    """
+    Processes a partition of chunk tasks within a single
+    GDAL environment, in row-major order per image so that
+    consecutive tiles read neighboring source blocks
+
+    Tasks are processed sequentially: GDAL 1.11 has a single
+    process-wide block cache that is not safe to use from several
+    threads, and Spark already runs one partition per core.
+    """
+    with rasterio.drivers(**GDAL_CONFIG):
+        try:
+            for task in sorted(tasks,
+                               key=lambda t: (t.source_uri, t.row, t.col)):
+                process_chunk_task(task)
+        finally:
+            close_sources()
+
+
 def construct_image_info(image_source):
     extent = {"xmin": image_source.ll_bounds[0],
               "ymin": image_source.ll_bounds[1],
@@ -357,23 +550,6 @@ def construct_image_info(image_source):
 
 def run_spark_job(tile_dim, args):
     from pyspark import SparkConf, SparkContext
-    from pyspark.accumulators import AccumulatorParam
-
-    class ImageSourceAccumulatorParam(AccumulatorParam):
-        """
-        Accumulator that will collect our image data that will be
-        included as part of the input to the next stage of processing.
-        """
-        def zero(self, dummy):
-            return []
-
-        def addInPlace(self, sources1, sources2):
-            res = []
-            if sources1:
-                res.extend(sources1)
-            if sources2:
-                res.extend(sources2)
-            return res
 
     status_queue = args['--status-queue']
     source_uris = args['<image>']
@@ -391,38 +567,58 @@ def run_spark_job(tile_dim, args):
         conf = SparkConf().setAppName(APP_NAME)
         sc = SparkContext(conf=conf)
 
-        image_source_accumulator = \
-            sc.accumulator([], ImageSourceAccumulatorParam())
-
-        def create_image_sources(uri_set, acc):
-            image_source = create_image_source(uri_set.source_uri,
-                                               uri_set.workspace_source_uri,
-                                               uri_set.image_folder,
-                                               uri_set.order, tile_dim)
-            acc += [image_source]
-            return image_source
-
         def uri_set_copy(uri_set):
+            if is_tiled_geotiff(uri_set.source_uri):
+                return uri_set._replace(
+                    workspace_source_uri=uri_set.source_uri)
+
             copy_to_workspace(uri_set.source_uri, uri_set.workspace_target)
             return uri_set
 
+        def uri_set_image_source(uri_set):
+            return create_image_source(uri_set.source_uri,
+                                       uri_set.workspace_source_uri,
+                                       uri_set.image_folder,
+                                       uri_set.order, tile_dim)
+
         uri_set_rdd = sc.parallelize(uri_sets, image_count).map(uri_set_copy)
-        image_sources = uri_set_rdd.map(
-            lambda uri_set: create_image_sources(uri_set,
-                                                 image_source_accumulator))
+        image_sources = uri_set_rdd.map(uri_set_image_source).cache()
         chunk_tasks = image_sources.flatMap(
             lambda image_source: generate_chunk_tasks(image_source, tile_dim))
         chunks_count = chunk_tasks.cache().count()
-        num_partitions = max(chunks_count / 10, min(50, image_count))
-
-        chunk_tasks.repartition(num_partitions).foreach(process_chunk_task)
-
-        image_sources = image_source_accumulator.value
-        print "Processed %d images into %d chunks" % (len(image_sources),
-                                                      chunks_count)
-
-        input_info = map(construct_image_info, sorted(image_sources,
-                                                      key=lambda im: im.order))
+        # A few partitions per core evens out stragglers. Tasks are
+        # dealt out below in equal contiguous runs and the partition
+        # count is trimmed so that none is left empty. The number of
+        # busy tasks is therefore min(num_partitions, cores), and each
+        # uploads one tile at a time, so S3 sees at most one
+        # concurrent PUT per core.
+        num_partitions = max(sc.defaultParallelism * PARTITIONS_PER_CORE,
+                             min(200, image_count))
+        tasks_per_partition = max(-(-chunks_count // num_partitions), 1)
+        num_partitions = max(-(-chunks_count // tasks_per_partition), 1)
+
+        # Split the tasks, in row-major order per image, into equal
+        # contiguous runs. Each source is then opened (and its blocks
+        # cached) by as few workers as possible, while every partition
+        # still gets the same share of tiles. Partitioning on the sort
+        # index also avoids hashing string keys.
+        chunk_tasks.sortBy(lambda task: (task.source_uri,
+                                         task.row,
+                                         task.col)) \
+                   .zipWithIndex() \
+                   .map(lambda task_index: (task_index[1], task_index[0])) \
+                   .partitionBy(num_partitions,
+                                lambda index: index // tasks_per_partition) \
+                   .values() \
+                   .foreachPartition(process_chunk_tasks)
+
+        image_sources = image_sources.collect()
+        print("Processed %d images into %d chunks" % (len(image_sources),
+                                                      chunks_count))
+
+        input_info = [construct_image_info(image_source)
+                      for image_source in sorted(image_sources,
+                                                 key=lambda im: im.order)]
 
         result = {
             "jobId": job_id,
@@ -442,14 +638,14 @@ def run_spark_job(tile_dim, args):
             # Strip leading slash
             key = path_parsed.path.strip('/')
             client.put_object(Bucket=bucket, Key=key, Body=json.dumps(result))
-    except Exception, e:
-        message = "%s: %s" % (type(e).__name__, e.message)
+    except Exception as e:
+        message = "%s: %s" % (type(e).__name__, e)
         notify_failure(status_queue, job_id, message)
         raise
 
     notify_success(status_queue, job_id)
 
-    print "Done."
+    print("Done.")
 
 
 def main():